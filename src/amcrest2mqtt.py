@@ -1,39 +1,128 @@
-from slugify import slugify
 from amcrest import AmcrestCamera, AmcrestError
-from datetime import datetime, timezone
 import paho.mqtt.client as mqtt
+import logging
 import os
+import queue
+import re
 import sys
-from json import dumps
 import signal
-from threading import Timer
+import socket
 import ssl
+import time
+import unicodedata
 import asyncio
+from threading import Thread
+from types import SimpleNamespace
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    # orjson is much faster and returns bytes, which paho publishes as-is
+    from orjson import dumps
+except ImportError:
+    import json
+
+    def dumps(obj):
+        # Match orjson: compact separators, and bytes so paho never has to encode the payload itself
+        return json.dumps(obj, separators=(",", ":")).encode()
 
 is_exiting = False
 mqtt_client = None
+_publish = None
+
+# Payloads sent over and over, encoded up front so paho doesn't have to encode them on every publish
+PAYLOAD_ON = b"on"
+PAYLOAD_OFF = b"off"
+PAYLOAD_ONLINE = b"online"
+PAYLOAD_OFFLINE = b"offline"
+
+log_levels = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARN": logging.WARNING, "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+
+@dataclass(frozen=True)
+class Config:
+    amcrest_host: Optional[str]
+    amcrest_port: int
+    amcrest_username: str
+    amcrest_password: Optional[str]
+
+    storage_poll_interval: int
+    device_name: Optional[str]
+
+    mqtt_host: str
+    mqtt_qos: int
+    mqtt_port: int
+    mqtt_username: Optional[str]
+    mqtt_password: Optional[str]  # can be None
+    mqtt_tls_enabled: bool
+    mqtt_tls_ca_cert: Optional[str]
+    mqtt_tls_cert: Optional[str]
+    mqtt_tls_key: Optional[str]
+
+    home_assistant: bool
+    home_assistant_prefix: str
+
+    dedup: bool
+    publish_raw_events: bool
+    log_level: int
+
+    @classmethod
+    def from_env(cls):
+        # All environment variables are read and parsed here, once, at startup
+        env = os.environ
+
+        return cls(
+            amcrest_host=env.get("AMCREST_HOST"),
+            amcrest_port=int(env.get("AMCREST_PORT") or 80),
+            amcrest_username=env.get("AMCREST_USERNAME") or "admin",
+            amcrest_password=env.get("AMCREST_PASSWORD"),
+            storage_poll_interval=int(env.get("STORAGE_POLL_INTERVAL") or 3600),
+            device_name=env.get("DEVICE_NAME"),
+            mqtt_host=env.get("MQTT_HOST") or "localhost",
+            mqtt_qos=int(env.get("MQTT_QOS") or 0),
+            mqtt_port=int(env.get("MQTT_PORT") or 1883),
+            mqtt_username=env.get("MQTT_USERNAME"),
+            mqtt_password=env.get("MQTT_PASSWORD"),
+            mqtt_tls_enabled=env.get("MQTT_TLS_ENABLED") == "true",
+            mqtt_tls_ca_cert=env.get("MQTT_TLS_CA_CERT"),
+            mqtt_tls_cert=env.get("MQTT_TLS_CERT"),
+            mqtt_tls_key=env.get("MQTT_TLS_KEY"),
+            home_assistant=env.get("HOME_ASSISTANT") == "true",
+            home_assistant_prefix=env.get("HOME_ASSISTANT_PREFIX") or "homeassistant",
+            dedup=env.get("DEDUP") == "true",
+            publish_raw_events=(env.get("PUBLISH_RAW_EVENTS") or "true") == "true",
+            log_level=log_levels.get((env.get("LOG_LEVEL") or "INFO").upper(), log_levels["INFO"]),
+        )
+
+class LogFormatter(logging.Formatter):
+    converter = time.gmtime
+
+    # Timestamps only have one second resolution, so only format one when the second changes
+    last_second = None
+    last_time = ""
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+
+        if second != self.last_second:
+            self.last_time = time.strftime(datefmt or self.default_time_format, self.converter(second))
+            self.last_second = second
+
+        return self.last_time
 
 # Read env variables
-amcrest_host = os.getenv("AMCREST_HOST")
-amcrest_port = int(os.getenv("AMCREST_PORT") or 80)
-amcrest_username = os.getenv("AMCREST_USERNAME") or "admin"
-amcrest_password = os.getenv("AMCREST_PASSWORD")
-
-storage_poll_interval = int(os.getenv("STORAGE_POLL_INTERVAL") or 3600)
-device_name = os.getenv("DEVICE_NAME")
-
-mqtt_host = os.getenv("MQTT_HOST") or "localhost"
-mqtt_qos = int(os.getenv("MQTT_QOS") or 0)
-mqtt_port = int(os.getenv("MQTT_PORT") or 1883)
-mqtt_username = os.getenv("MQTT_USERNAME")
-mqtt_password = os.getenv("MQTT_PASSWORD")  # can be None
-mqtt_tls_enabled = os.getenv("MQTT_TLS_ENABLED") == "true"
-mqtt_tls_ca_cert = os.getenv("MQTT_TLS_CA_CERT")
-mqtt_tls_cert = os.getenv("MQTT_TLS_CERT")
-mqtt_tls_key = os.getenv("MQTT_TLS_KEY")
-
-home_assistant = os.getenv("HOME_ASSISTANT") == "true"
-home_assistant_prefix = os.getenv("HOME_ASSISTANT_PREFIX") or "homeassistant"
+cfg = Config.from_env()
+
+# QoS 0 is fire-and-forget, there's no acknowledgement worth waiting for
+mqtt_wait_for_ack = cfg.mqtt_qos > 0
+
+# Set up logging, messages below LOG_LEVEL are dropped before they're formatted
+logger = logging.getLogger("amcrest2mqtt")
+log_handler = logging.StreamHandler(sys.stdout)
+log_formatter = LogFormatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%d/%m/%Y %H:%M:%S")
+log_handler.setFormatter(log_formatter)
+logger.addHandler(log_handler)
+logger.setLevel(cfg.log_level)
+log_debug = logger.debug
 
 def read_file(file_name):
     with open(file_name, 'r') as file:
@@ -48,64 +137,139 @@ def read_version():
     return read_file("../VERSION")
 
 # Helper functions and callbacks
-def log(msg, level="INFO"):
-    ts = datetime.now(timezone.utc).strftime("%d/%m/%Y %H:%M:%S")
-    print(f"{ts} [{level}] {msg}")
-
-def mqtt_publish(topic, payload, exit_on_error=True, json=False):
-    global mqtt_client
-
-    msg = mqtt_client.publish(
-        topic, payload=(dumps(payload) if json else payload), qos=mqtt_qos, retain=True
+SLUG_PATTERN = re.compile(r"[^a-z0-9]+")
+
+def slugify(text):
+    # Device names are almost always plain ASCII, so fold any accents and replace everything else with underscores.
+    # Unlike python-slugify there's no transliteration, so e.g. "Straße" gives "strae" and non-Latin text is dropped
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return SLUG_PATTERN.sub("_", text.lower()).strip("_")
+
+# Called for every event, so the helpers it needs are bound as defaults (local lookups) rather than globals
+def mqtt_publish(
+    topic,
+    payload,
+    exit_on_error=True,
+    json=False,
+    wait=True,
+    _dumps=dumps,
+    _mqtt_err_success=mqtt.MQTT_ERR_SUCCESS,
+    _mqtt_error_string=mqtt.error_string,
+    _qos=cfg.mqtt_qos,
+    _wait_for_ack=mqtt_wait_for_ack,
+):
+    msg = _publish(
+        topic, payload=(_dumps(payload) if json else payload), qos=_qos, retain=True
     )
 
-    if msg.rc == mqtt.MQTT_ERR_SUCCESS:
-        msg.wait_for_publish(2)
+    if msg.rc == _mqtt_err_success:
+        # Callers sending several messages in a row can pass wait=False for all but the last, so they are acknowledged
+        # together
+        if wait and _wait_for_ack:
+            msg.wait_for_publish(2)
         return
 
-    log(f"Error publishing MQTT message: {mqtt.error_string(msg.rc)}", level="ERROR")
+    logger.error("Error publishing MQTT message: %s", _mqtt_error_string(msg.rc))
 
     if exit_on_error:
         exit_gracefully(msg.rc, skip_mqtt=True)
 
+def mqtt_publish_many(
+    messages,
+    _mqtt_err_success=mqtt.MQTT_ERR_SUCCESS,
+    _mqtt_error_string=mqtt.error_string,
+    _qos=cfg.mqtt_qos,
+    _wait_for_ack=mqtt_wait_for_ack,
+):
+    # Queue every message without waiting, then wait once on the last one
+    msg = None
+
+    for topic, payload in messages:
+        msg = _publish(topic, payload=payload, qos=_qos, retain=True)
+
+        if msg.rc != _mqtt_err_success:
+            logger.error("Error publishing MQTT message: %s", _mqtt_error_string(msg.rc))
+            exit_gracefully(msg.rc, skip_mqtt=True)
+
+    if msg is not None and _wait_for_ack:
+        msg.wait_for_publish(2)
+
+def on_mqtt_connect(client, userdata, flags, rc):
+    # Disable Nagle's algorithm so back-to-back publishes (e.g. motion then event) aren't held up waiting on ACKs.
+    # Done on every connect as paho creates a new socket each time it reconnects
+    sock = client.socket()
+
+    if rc == 0 and sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
 def on_mqtt_disconnect(client, userdata, rc):
     if rc != 0:
-        log(f"Unexpected MQTT disconnection", level="ERROR")
+        logger.error("Unexpected MQTT disconnection")
         exit_gracefully(rc, skip_mqtt=True)
 
 def exit_gracefully(rc, skip_mqtt=False):
     global topics, mqtt_client
 
-    log("Exiting app...")
+    logger.info("Exiting app...")
 
-    if mqtt_client is not None and mqtt_client.is_connected() and skip_mqtt == False:
-        mqtt_publish(topics["status"], "offline", exit_on_error=False)
+    # Check skip_mqtt first so an abnormal exit never touches the client's state
+    if not skip_mqtt and mqtt_client is not None and mqtt_client.is_connected():
+        mqtt_publish(topics.status, PAYLOAD_OFFLINE, exit_on_error=False)
         mqtt_client.disconnect()
 
     # Use os._exit instead of sys.exit to ensure an MQTT disconnect event causes the program to exit correctly as they
     # occur on a separate thread
     os._exit(rc)
 
-def refresh_storage_sensors():
-    global camera, topics, storage_poll_interval
+async def refresh_storage_sensors():
+    global camera, topics
 
-    Timer(storage_poll_interval, refresh_storage_sensors).start()
-    log("Fetching storage sensors...")
+    # Runs as a task on the main event loop alongside the event stream. The fetch itself uses amcrest's sync API in a
+    # worker thread: the async API's token lock is created with the camera at import time and, on Python 3.9, is bound
+    # to a different loop than the one asyncio.run starts
+    while True:
+        logger.info("Fetching storage sensors...")
 
-    try:
-        storage = camera.storage_all
+        try:
+            storage = await asyncio.to_thread(lambda: camera.storage_all)
+
+            # Never wait for acknowledgements here, that would block the event loop and with it the camera stream
+            mqtt_publish(topics.storage_used_percent, str(storage["used_percent"]), wait=False)
+            mqtt_publish(topics.storage_used, to_gb(storage["used"]), wait=False)
+            mqtt_publish(topics.storage_total, to_gb(storage["total"]), wait=False)
+        except AmcrestError as error:
+            logger.warning("Error fetching storage information %s", error)
+        except Exception as error:
+            # Keep polling, an unexpected value (e.g. an "unknown" size) shouldn't stop the sensors for good
+            logger.exception("Unexpected error refreshing storage sensors: %s", error)
 
-        mqtt_publish(topics["storage_used_percent"], str(storage["used_percent"]))
-        mqtt_publish(topics["storage_used"], to_gb(storage["used"]))
-        mqtt_publish(topics["storage_total"], to_gb(storage["total"]))
+        await asyncio.sleep(cfg.storage_poll_interval)
+
+async def read_events(events):
+    global camera
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        async for code, payload in camera.async_event_actions("All"):
+            try:
+                events.put_nowait((code, payload))
+            except queue.Full:
+                # The publisher has fallen behind, so stop reading from the camera until there's room again
+                await loop.run_in_executor(None, events.put, (code, payload))
     except AmcrestError as error:
-        log(f"Error fetching storage information {error}", level="WARNING")
+        logger.error("Amcrest error: %s", error)
+        exit_gracefully(1)
+
+    # The stream has ended, let the publisher finish
+    await loop.run_in_executor(None, events.put, None)
 
 def to_gb(total):
-    return str(round(float(total[0]) / 1024 / 1024 / 1024, 2))
+    # 1073741824 = 1024 ** 3
+    return f"{float(total[0]) / 1073741824:.2f}"
 
-def signal_handler(sig, frame):
-    # exit immediately upon receiving a second SIGINT
+def signal_handler(sig, frame=None):
+    # exit immediately upon receiving a second SIGINT/SIGTERM
     global is_exiting
 
     if is_exiting:
@@ -115,32 +279,33 @@ def signal_handler(sig, frame):
     exit_gracefully(0)
 
 # Exit if any of the required vars are not provided
-if amcrest_host is None:
-    log("Please set the AMCREST_HOST environment variable", level="ERROR")
+if cfg.amcrest_host is None:
+    logger.error("Please set the AMCREST_HOST environment variable")
     sys.exit(1)
 
-if amcrest_password is None:
-    log("Please set the AMCREST_PASSWORD environment variable", level="ERROR")
+if cfg.amcrest_password is None:
+    logger.error("Please set the AMCREST_PASSWORD environment variable")
     sys.exit(1)
 
-if mqtt_username is None:
-    log("Please set the MQTT_USERNAME environment variable", level="ERROR")
+if cfg.mqtt_username is None:
+    logger.error("Please set the MQTT_USERNAME environment variable")
     sys.exit(1)
 
 version = read_version()
 
-log(f"App Version: {version}")
+logger.info("App Version: %s", version)
 
 # Handle interruptions
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
 
 # Connect to camera
 camera = AmcrestCamera(
-    amcrest_host, amcrest_port, amcrest_username, amcrest_password
+    cfg.amcrest_host, cfg.amcrest_port, cfg.amcrest_username, cfg.amcrest_password
 ).camera
 
 # Fetch camera details
-log("Fetching camera details...")
+logger.info("Fetching camera details...")
 
 try:
     device_type = camera.device_type.replace("type=", "").strip()
@@ -150,7 +315,7 @@ try:
     serial_number = camera.serial_number
 
     if not isinstance(serial_number, str):
-        log(f"Error fetching serial number", level="ERROR")
+        logger.error("Error fetching serial number")
         exit_gracefully(1)
 
     sw_version = camera.software_information[0].replace("version=", "").strip()
@@ -158,95 +323,109 @@ try:
 
     amcrest_version = f"{sw_version} ({build_version})"
 
+    device_name = cfg.device_name
+
     if not device_name:
         device_name = camera.machine_name.replace("name=", "").strip()
 
-    device_slug = slugify(device_name, separator="_")
+    # Names with no Latin characters (e.g. CJK) slugify to nothing, fall back to the serial number
+    device_slug = slugify(device_name) or slugify(serial_number)
 except AmcrestError as error:
-    log(f"Error fetching camera details", level="ERROR")
+    logger.error("Error fetching camera details")
     exit_gracefully(1)
 
-log(f"Device type: {device_type}")
-log(f"Serial number: {serial_number}")
-log(f"Software version: {amcrest_version}")
-log(f"Device name: {device_name}")
-
-# MQTT topics
-topics = {
-    "config": f"amcrest2mqtt/{serial_number}/config",
-    "status": f"amcrest2mqtt/{serial_number}/status",
-    "event": f"amcrest2mqtt/{serial_number}/event",
-    "motion": f"amcrest2mqtt/{serial_number}/motion",
-    "doorbell": f"amcrest2mqtt/{serial_number}/doorbell",
-    "human": f"amcrest2mqtt/{serial_number}/human",
-    "storage_used": f"amcrest2mqtt/{serial_number}/storage/used",
-    "storage_used_percent": f"amcrest2mqtt/{serial_number}/storage/used_percent",
-    "storage_total": f"amcrest2mqtt/{serial_number}/storage/total",
-    "home_assistant_legacy": {
-        "doorbell": f"{home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/{device_slug}_doorbell/config",
-        "human": f"{home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/{device_slug}_human/config",
-        "motion": f"{home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/{device_slug}_motion/config",
-        "storage_used": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_storage_used/config",
-        "storage_used_percent": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_storage_used_percent/config",
-        "storage_total": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_storage_total/config",
-        "version": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_version/config",
-        "host": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_host/config",
-        "serial_number": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_serial_number/config",
+logger.info("Device type: %s", device_type)
+logger.info("Serial number: %s", serial_number)
+logger.info("Software version: %s", amcrest_version)
+logger.info("Device name: %s", device_name)
+
+# MQTT topics (a namespace rather than a dict so the per-event lookups are plain attribute access)
+topics = SimpleNamespace(
+    config=f"amcrest2mqtt/{serial_number}/config",
+    status=f"amcrest2mqtt/{serial_number}/status",
+    event=f"amcrest2mqtt/{serial_number}/event",
+    motion=f"amcrest2mqtt/{serial_number}/motion",
+    doorbell=f"amcrest2mqtt/{serial_number}/doorbell",
+    human=f"amcrest2mqtt/{serial_number}/human",
+    storage_used=f"amcrest2mqtt/{serial_number}/storage/used",
+    storage_used_percent=f"amcrest2mqtt/{serial_number}/storage/used_percent",
+    storage_total=f"amcrest2mqtt/{serial_number}/storage/total",
+    home_assistant_legacy={
+        "doorbell": f"{cfg.home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/{device_slug}_doorbell/config",
+        "human": f"{cfg.home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/{device_slug}_human/config",
+        "motion": f"{cfg.home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/{device_slug}_motion/config",
+        "storage_used": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_storage_used/config",
+        "storage_used_percent": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_storage_used_percent/config",
+        "storage_total": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_storage_total/config",
+        "version": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_version/config",
+        "host": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_host/config",
+        "serial_number": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/{device_slug}_serial_number/config",
     },
-    "home_assistant": {
-        "doorbell": f"{home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/doorbell/config",
-        "human": f"{home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/human/config",
-        "motion": f"{home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/motion/config",
-        "storage_used": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/storage_used/config",
-        "storage_used_percent": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/storage_used_percent/config",
-        "storage_total": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/storage_total/config",
-        "version": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/version/config",
-        "host": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/host/config",
-        "serial_number": f"{home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/serial_number/config",
+    home_assistant={
+        "doorbell": f"{cfg.home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/doorbell/config",
+        "human": f"{cfg.home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/human/config",
+        "motion": f"{cfg.home_assistant_prefix}/binary_sensor/amcrest2mqtt-{serial_number}/motion/config",
+        "storage_used": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/storage_used/config",
+        "storage_used_percent": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/storage_used_percent/config",
+        "storage_total": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/storage_total/config",
+        "version": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/version/config",
+        "host": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/host/config",
+        "serial_number": f"{cfg.home_assistant_prefix}/sensor/amcrest2mqtt-{serial_number}/serial_number/config",
     },
-}
+)
 
-# Connect to MQTT
+# Connect to MQTT (we never subscribe and all state is retained, so there is no session worth the broker keeping)
 mqtt_client = mqtt.Client(
-    client_id=f"amcrest2mqtt_{serial_number}", clean_session=False
+    client_id=f"amcrest2mqtt_{serial_number}", clean_session=True
 )
+mqtt_client.on_connect = on_mqtt_connect
 mqtt_client.on_disconnect = on_mqtt_disconnect
-mqtt_client.will_set(topics["status"], payload="offline", qos=mqtt_qos, retain=True)
-if mqtt_tls_enabled:
-    log(f"Setting up MQTT for TLS")
-    if mqtt_tls_ca_cert is None:
-        log("Missing var: MQTT_TLS_CA_CERT", level="ERROR")
+if cfg.mqtt_qos > 0:
+    # Allow bursts (startup discovery, an event plus its state topic) to be in flight together rather than
+    # queueing behind paho's default window of 20 unacknowledged messages
+    mqtt_client.max_inflight_messages_set(100)
+    mqtt_client.max_queued_messages_set(0)
+mqtt_client.will_set(topics.status, payload=PAYLOAD_OFFLINE, qos=cfg.mqtt_qos, retain=True)
+if cfg.mqtt_tls_enabled:
+    logger.info("Setting up MQTT for TLS")
+    if cfg.mqtt_tls_ca_cert is None:
+        logger.error("Missing var: MQTT_TLS_CA_CERT")
         sys.exit(1)
-    if mqtt_tls_cert is None:
-        log("Missing var: MQTT_TLS_CERT", level="ERROR")
+    if cfg.mqtt_tls_cert is None:
+        logger.error("Missing var: MQTT_TLS_CERT")
         sys.exit(1)
-    if mqtt_tls_cert is None:
-        log("Missing var: MQTT_TLS_KEY", level="ERROR")
+    if cfg.mqtt_tls_cert is None:
+        logger.error("Missing var: MQTT_TLS_KEY")
         sys.exit(1)
     mqtt_client.tls_set(
-        ca_certs=mqtt_tls_ca_cert,
-        certfile=mqtt_tls_cert,
-        keyfile=mqtt_tls_key,
+        ca_certs=cfg.mqtt_tls_ca_cert,
+        certfile=cfg.mqtt_tls_cert,
+        keyfile=cfg.mqtt_tls_key,
         cert_reqs=ssl.CERT_REQUIRED,
         tls_version=ssl.PROTOCOL_TLS,
     )
 else:
-    mqtt_client.username_pw_set(mqtt_username, password=mqtt_password)
+    mqtt_client.username_pw_set(cfg.mqtt_username, password=cfg.mqtt_password)
 
 try:
-    mqtt_client.connect(mqtt_host, port=mqtt_port)
+    mqtt_client.connect(cfg.mqtt_host, port=cfg.mqtt_port)
     mqtt_client.loop_start()
+    _publish = mqtt_client.publish
 except ConnectionError as error:
-    log(f"Could not connect to MQTT server: {error}", level="ERROR")
+    logger.error("Could not connect to MQTT server: %s", error)
     sys.exit(1)
 
+# Discovery config is collected and sent in one batch with the startup messages, so startup doesn't wait on the
+# broker for each message in turn. Every payload is serialized to bytes as it's added
+discovery = []
+
 # Configure Home Assistant
-if home_assistant:
-    log("Writing Home Assistant discovery config...")
+if cfg.home_assistant:
+    logger.info("Writing Home Assistant discovery config...")
 
     base_config = {
-        "availability_topic": topics["status"],
-        "qos": mqtt_qos,
+        "availability_topic": topics.status,
+        "qos": cfg.mqtt_qos,
         "device": {
             "name": f"Amcrest {device_type}",
             "manufacturer": "Amcrest",
@@ -257,184 +436,251 @@ if home_assistant:
         },
     }
 
+    def ha_config(**overrides):
+        # Every discovery message shares the availability and device details in base_config
+        return base_config | overrides
+
     if is_doorbell:
         doorbell_name = "Doorbell" if device_name == "Doorbell" else f"{device_name} Doorbell"
 
-        mqtt_publish(topics["home_assistant_legacy"]["doorbell"], "")
-        mqtt_publish(
-            topics["home_assistant"]["doorbell"],
-            base_config
-            | {
-                "state_topic": topics["doorbell"],
-                "payload_on": "on",
-                "payload_off": "off",
-                "icon": "mdi:doorbell",
-                "name": doorbell_name,
-                "unique_id": f"{serial_number}.doorbell",
-            },
-            json=True,
-        )
+        discovery.append((topics.home_assistant_legacy["doorbell"], b""))
+        discovery.append((
+            topics.home_assistant["doorbell"],
+            dumps(ha_config(
+                state_topic=topics.doorbell,
+                payload_on="on",
+                payload_off="off",
+                icon="mdi:doorbell",
+                name=doorbell_name,
+                unique_id=f"{serial_number}.doorbell",
+            )),
+        ))
 
     if is_ad410:
-        mqtt_publish(topics["home_assistant_legacy"]["human"], "")
-        mqtt_publish(
-            topics["home_assistant"]["human"],
-            base_config
-            | {
-                "state_topic": topics["human"],
-                "payload_on": "on",
-                "payload_off": "off",
-                "device_class": "motion",
-                "name": f"{device_name} Human",
-                "unique_id": f"{serial_number}.human",
-            },
-            json=True,
-        )
+        discovery.append((topics.home_assistant_legacy["human"], b""))
+        discovery.append((
+            topics.home_assistant["human"],
+            dumps(ha_config(
+                state_topic=topics.human,
+                payload_on="on",
+                payload_off="off",
+                device_class="motion",
+                name=f"{device_name} Human",
+                unique_id=f"{serial_number}.human",
+            )),
+        ))
+
+    discovery.append((topics.home_assistant_legacy["motion"], b""))
+    discovery.append((
+        topics.home_assistant["motion"],
+        dumps(ha_config(
+            state_topic=topics.motion,
+            payload_on="on",
+            payload_off="off",
+            device_class="motion",
+            name=f"{device_name} Motion",
+            unique_id=f"{serial_number}.motion",
+        )),
+    ))
+
+    discovery.append((topics.home_assistant_legacy["version"], b""))
+    discovery.append((
+        topics.home_assistant["version"],
+        dumps(ha_config(
+            state_topic=topics.config,
+            value_template="{{ value_json.sw_version }}",
+            icon="mdi:package-up",
+            name=f"{device_name} Version",
+            unique_id=f"{serial_number}.version",
+            entity_category="diagnostic",
+            enabled_by_default=False,
+        )),
+    ))
+
+    discovery.append((topics.home_assistant_legacy["serial_number"], b""))
+    discovery.append((
+        topics.home_assistant["serial_number"],
+        dumps(ha_config(
+            state_topic=topics.config,
+            value_template="{{ value_json.serial_number }}",
+            icon="mdi:alphabetical-variant",
+            name=f"{device_name} Serial Number",
+            unique_id=f"{serial_number}.serial_number",
+            entity_category="diagnostic",
+            enabled_by_default=False,
+        )),
+    ))
+
+    discovery.append((topics.home_assistant_legacy["host"], b""))
+    discovery.append((
+        topics.home_assistant["host"],
+        dumps(ha_config(
+            state_topic=topics.config,
+            value_template="{{ value_json.host }}",
+            icon="mdi:ip-network",
+            name=f"{device_name} Host",
+            unique_id=f"{serial_number}.host",
+            entity_category="diagnostic",
+            enabled_by_default=False,
+        )),
+    ))
+
+    if cfg.storage_poll_interval > 0:
+        discovery.append((topics.home_assistant_legacy["storage_used_percent"], b""))
+        discovery.append((
+            topics.home_assistant["storage_used_percent"],
+            dumps(ha_config(
+                state_topic=topics.storage_used_percent,
+                unit_of_measurement="%",
+                icon="mdi:micro-sd",
+                name=f"{device_name} Storage Used %",
+                object_id=f"{device_slug}_storage_used_percent",
+                unique_id=f"{serial_number}.storage_used_percent",
+                entity_category="diagnostic",
+            )),
+        ))
+
+        discovery.append((topics.home_assistant_legacy["storage_used"], b""))
+        discovery.append((
+            topics.home_assistant["storage_used"],
+            dumps(ha_config(
+                state_topic=topics.storage_used,
+                unit_of_measurement="GB",
+                icon="mdi:micro-sd",
+                name=f"{device_name} Storage Used",
+                unique_id=f"{serial_number}.storage_used",
+                entity_category="diagnostic",
+            )),
+        ))
+
+        discovery.append((topics.home_assistant_legacy["storage_total"], b""))
+        discovery.append((
+            topics.home_assistant["storage_total"],
+            dumps(ha_config(
+                state_topic=topics.storage_total,
+                unit_of_measurement="GB",
+                icon="mdi:micro-sd",
+                name=f"{device_name} Storage Total",
+                unique_id=f"{serial_number}.storage_total",
+                entity_category="diagnostic",
+            )),
+        ))
+
+# The device configuration doesn't change while running, so it's only serialized once
+config_payload = dumps({
+    "version": version,
+    "device_type": device_type,
+    "device_name": device_name,
+    "sw_version": amcrest_version,
+    "serial_number": serial_number,
+    "host": cfg.amcrest_host,
+})
 
-    mqtt_publish(topics["home_assistant_legacy"]["motion"], "")
-    mqtt_publish(
-        topics["home_assistant"]["motion"],
-        base_config
-        | {
-            "state_topic": topics["motion"],
-            "payload_on": "on",
-            "payload_off": "off",
-            "device_class": "motion",
-            "name": f"{device_name} Motion",
-            "unique_id": f"{serial_number}.motion",
-        },
-        json=True,
-    )
+# Main loop
+mqtt_publish_many(discovery + [
+    (topics.status, PAYLOAD_ONLINE),
+    (topics.config, config_payload),
+])
+
+logger.info("Listening for events...")
+
+def publish_events(events):
+    # Bind the topics used for every event to locals, saving a global and attribute lookup per publish
+    motion_topic = topics.motion
+    human_topic = topics.human
+    doorbell_topic = topics.doorbell
+    event_topic = topics.event
+
+    # Handlers return the (topic, payload) state update for an event, or None if there's nothing to update
+    def handle_motion(payload):
+        return motion_topic, PAYLOAD_ON if payload["action"] == "Start" else PAYLOAD_OFF
+
+    def handle_cross_region(payload):
+        if payload["data"]["ObjectType"] != "Human":
+            return None
+
+        return human_topic, PAYLOAD_ON if payload["action"] == "Start" else PAYLOAD_OFF
+
+    def handle_talk(payload):
+        return doorbell_topic, PAYLOAD_ON if payload["data"]["Action"] == "Invite" else PAYLOAD_OFF
+
+    # The AD110 reports motion as ProfileAlarmTransmit, everything else uses VideoMotion
+    handlers = {
+        "ProfileAlarmTransmit" if is_ad110 else "VideoMotion": handle_motion,
+        "CrossRegionDetection": handle_cross_region,
+        "_DoTalkAction_": handle_talk,
+    }
 
-    mqtt_publish(topics["home_assistant_legacy"]["version"], "")
-    mqtt_publish(
-        topics["home_assistant"]["version"],
-        base_config
-        | {
-            "state_topic": topics["config"],
-            "value_template": "{{ value_json.sw_version }}",
-            "icon": "mdi:package-up",
-            "name": f"{device_name} Version",
-            "unique_id": f"{serial_number}.version",
-            "entity_category": "diagnostic",
-            "enabled_by_default": False
-        },
-        json=True,
-    )
+    # Cameras often repeat a state (e.g. several motion Start events in a row), optionally only publish changes
+    dedup = cfg.dedup
+    last_states = {}
 
-    mqtt_publish(topics["home_assistant_legacy"]["serial_number"], "")
-    mqtt_publish(
-        topics["home_assistant"]["serial_number"],
-        base_config
-        | {
-            "state_topic": topics["config"],
-            "value_template": "{{ value_json.serial_number }}",
-            "icon": "mdi:alphabetical-variant",
-            "name": f"{device_name} Serial Number",
-            "unique_id": f"{serial_number}.serial_number",
-            "entity_category": "diagnostic",
-            "enabled_by_default": False
-        },
-        json=True,
-    )
+    # Serializing the whole payload is the largest per-event cost, skip it if nothing listens to the event topic
+    publish_raw_events = cfg.publish_raw_events
 
-    mqtt_publish(topics["home_assistant_legacy"]["host"], "")
-    mqtt_publish(
-        topics["home_assistant"]["host"],
-        base_config
-        | {
-            "state_topic": topics["config"],
-            "value_template": "{{ value_json.host }}",
-            "icon": "mdi:ip-network",
-            "name": f"{device_name} Host",
-            "unique_id": f"{serial_number}.host",
-            "entity_category": "diagnostic",
-            "enabled_by_default": False
-        },
-        json=True,
-    )
+    # Bound to locals as they are used on every iteration
+    next_event = events.get
+    get_handler = handlers.get
+    publish = mqtt_publish
 
-    if storage_poll_interval > 0:
-        mqtt_publish(topics["home_assistant_legacy"]["storage_used_percent"], "")
-        mqtt_publish(
-            topics["home_assistant"]["storage_used_percent"],
-            base_config
-            | {
-                "state_topic": topics["storage_used_percent"],
-                "unit_of_measurement": "%",
-                "icon": "mdi:micro-sd",
-                "name": f"{device_name} Storage Used %",
-                "object_id": f"{device_slug}_storage_used_percent",
-                "unique_id": f"{serial_number}.storage_used_percent",
-                "entity_category": "diagnostic",
-            },
-            json=True,
-        )
+    # Checked once up front so the call is skipped entirely, rather than made and dropped, for every event
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
 
-        mqtt_publish(topics["home_assistant_legacy"]["storage_used"], "")
-        mqtt_publish(
-            topics["home_assistant"]["storage_used"],
-            base_config
-            | {
-                "state_topic": topics["storage_used"],
-                "unit_of_measurement": "GB",
-                "icon": "mdi:micro-sd",
-                "name": f"{device_name} Storage Used",
-                "unique_id": f"{serial_number}.storage_used",
-                "entity_category": "diagnostic",
-            },
-            json=True,
-        )
+    while True:
+        event = next_event()
 
-        mqtt_publish(topics["home_assistant_legacy"]["storage_total"], "")
-        mqtt_publish(
-            topics["home_assistant"]["storage_total"],
-            base_config
-            | {
-                "state_topic": topics["storage_total"],
-                "unit_of_measurement": "GB",
-                "icon": "mdi:micro-sd",
-                "name": f"{device_name} Storage Total",
-                "unique_id": f"{serial_number}.storage_total",
-                "entity_category": "diagnostic",
-            },
-            json=True,
-        )
+        if event is None:
+            break
 
-# Main loop
-mqtt_publish(topics["status"], "online")
-mqtt_publish(topics["config"], {
-    "version": version,
-    "device_type": device_type,
-    "device_name": device_name,
-    "sw_version": amcrest_version,
-    "serial_number": serial_number,
-    "host": amcrest_host,
-}, json=True)
+        # An unexpected error would otherwise kill this thread silently, leaving the reader blocked on a full queue
+        # with nothing draining it. Exit instead, so the container restarts as it did before
+        try:
+            code, payload = event
+            handler = get_handler(code)
+
+            if handler is not None:
+                state = handler(payload)
+
+                if state is not None:
+                    topic, state_payload = state
+
+                    # When the raw event follows, both are acknowledged together when it's published
+                    if not dedup or last_states.get(topic) != state_payload:
+                        last_states[topic] = state_payload
+                        publish(topic, state_payload, wait=not publish_raw_events)
 
-if storage_poll_interval > 0:
-    refresh_storage_sensors()
+            if publish_raw_events:
+                publish(event_topic, payload, json=True)
 
-log("Listening for events...")
+            if debug_enabled:
+                log_debug("%s", payload)
+        except Exception:
+            logger.exception("Error publishing event")
+            exit_gracefully(1)
 
 async def main():
-    try:
-        async for code, payload in camera.async_event_actions("All"):
-            if (is_ad110 and code == "ProfileAlarmTransmit") or (code == "VideoMotion" and not is_ad110):
-                motion_payload = "on" if payload["action"] == "Start" else "off"
-                mqtt_publish(topics["motion"], motion_payload)
-            elif code == "CrossRegionDetection" and payload["data"]["ObjectType"] == "Human":
-                human_payload = "on" if payload["action"] == "Start" else "off"
-                mqtt_publish(topics["human"], human_payload)
-            elif code == "_DoTalkAction_":
-                doorbell_payload = "on" if payload["data"]["Action"] == "Invite" else "off"
-                mqtt_publish(topics["doorbell"], doorbell_payload)
-
-            mqtt_publish(topics["event"], payload, json=True)
-            log(str(payload))
+    # Once the event loop is running, deliver signals through it. asyncio wakes the loop via signal.set_wakeup_fd and
+    # the handler then runs as an ordinary callback on the main thread instead of interrupting whatever code (possibly
+    # holding one of paho's locks) happened to be executing
+    loop = asyncio.get_running_loop()
 
-    except AmcrestError as error:
-        log(f"Amcrest error: {error}", level="ERROR")
-        exit_gracefully(1)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, signal_handler, sig)
+
+    if cfg.storage_poll_interval > 0:
+        # Keep a reference so the task isn't garbage collected while it sleeps
+        storage_task = asyncio.create_task(refresh_storage_sensors())
+
+    # Events are serialized and published on a separate thread, so the camera stream is never held up by MQTT.
+    # The queue between them is bounded: if publishing falls behind, the reader stops pulling from the camera's
+    # HTTP stream rather than buffering an unbounded backlog of events in memory
+    events = queue.Queue(maxsize=64)
+    publisher = Thread(target=publish_events, args=(events,), daemon=True)
+    publisher.start()
+
+    await read_events(events)
+
+    # Let the publisher work through anything still queued before exiting
+    await loop.run_in_executor(None, publisher.join)
 
 asyncio.run(main())